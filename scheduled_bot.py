@@ -4,11 +4,15 @@ import json
 import asyncio
 import logging
 import re
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
 import base64
 import traceback
+from collections import deque
 
 # ----- CONFIGURATION -----
 WEBSITE_REPO = "streming0606/DealFamSheduler"  # GitHub repo for your website
@@ -17,17 +21,87 @@ SERP_API_KEY = os.environ.get('SERP_API_KEY')
 AMAZON_AFFILIATE_TAG = os.environ.get('AMAZON_TAG')  # Your affiliate tag
 SESSION_TYPE = os.environ.get('SESSION_TYPE', 'morning')
 PRODUCTS_PER_RUN = int(os.environ.get('PRODUCTS_PER_RUN', 2))  # Products per session
+MAX_WEBSITE_PRODUCTS = int(os.environ.get('MAX_WEBSITE_PRODUCTS', 500))  # Newest products kept in products.json
+SERP_CONCURRENCY = 5  # Max SerpAPI requests in flight at once
+GITHUB_MAX_RETRIES = 3  # Retries for rate-limited or 5xx GitHub responses
+GITHUB_MAX_WAIT = 60  # Longest backoff (seconds) worth waiting for inside one session
+
+IST = ZoneInfo('Asia/Kolkata')
+ASIN_RE = re.compile(r'/(?:dp|gp/product|product)/([A-Z0-9]{10})')
+TAG_RE = re.compile(r'[?&]tag=[^&]*')
+
+CATEGORY_KEYWORDS = {
+    'electronics': ['phone', 'smartphone', 'mobile', 'laptop', 'computer', 'tablet', 'earphone', 'headphone', 'charger', 'cable', 'speaker', 'camera', 'television'],
+    'fashion': ['shirt', 'tshirt', 'jeans', 'dress', 'shoes', 'watch', 'bag', 'clothing', 'jacket', 'cap', 'sunglasses', 'wallet'],
+    'home': ['kitchen', 'furniture', 'home', 'decor', 'appliance', 'bedsheet', 'pillow', 'chair', 'table', 'lamp', 'mattress', 'curtain'],
+    'health': ['skincare', 'beauty', 'cosmetic', 'health', 'supplement', 'medicine', 'cream', 'oil', 'soap', 'vitamin', 'hygiene']
+}
+# One alternation per category, checked in order so earlier categories keep priority
+CATEGORY_RES = tuple(
+    (category, re.compile('|'.join(map(re.escape, keywords))))
+    for category, keywords in CATEGORY_KEYWORDS.items()
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("WebsiteBot")
 
 class WebsiteAffiliateBot:
     def __init__(self):
+        self.http = self.create_http_session()
+        self.github_api = f"https://api.github.com/repos/{WEBSITE_REPO}"
+        self.github_headers = {
+            'Authorization': f'token {GITHUB_TOKEN}',
+            'Accept': 'application/vnd.github.v3+json'
+        }
+        self.serp_semaphore = asyncio.Semaphore(SERP_CONCURRENCY)
+        self.progress_payload = None  # Encoded progress.json, set by save_progress and committed by run()
         self.links = self.load_amazon_links()
-        self.current_index = self.load_progress()
+        progress = self.load_progress()
+        self.current_index = progress.get('current_index', 0)
+        self.cycle_number = progress.get('cycle_number', 1)
         logger.info(f"Loaded {len(self.links)} Amazon links, starting from index {self.current_index}")
         logger.info(f"Affiliate Tag: {AMAZON_AFFILIATE_TAG if AMAZON_AFFILIATE_TAG else 'NOT SET'}")
 
+    def create_http_session(self):
+        """Shared session so GitHub/SerpAPI calls reuse pooled connections"""
+        session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        session.mount('https://', adapter)
+        # GitHub status retries (incl. Retry-After) are owned by github_request, which caps the wait;
+        # without a status_forcelist and with Retry-After ignored, this adapter retries no HTTP status
+        github_retry = Retry(total=3, backoff_factor=0.3, respect_retry_after_header=False)
+        github_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8, max_retries=github_retry)
+        session.mount('https://api.github.com/', github_adapter)
+        return session
+
+    def github_request(self, method, url, **kwargs):
+        """Authenticated GitHub API call that backs off on rate limits and 5xx responses"""
+        for attempt in range(GITHUB_MAX_RETRIES + 1):
+            resp = self.http.request(method, url, headers=self.github_headers, **kwargs)
+            remaining = resp.headers.get('X-RateLimit-Remaining')
+            rate_limited = resp.status_code == 429 or (
+                resp.status_code == 403 and (remaining == '0' or 'Retry-After' in resp.headers)
+            )
+            if not rate_limited and resp.status_code < 500:
+                if remaining is not None and int(remaining) < 10:
+                    logger.warning(f"GitHub rate limit nearly exhausted: {remaining} requests left")
+                return resp
+            if attempt == GITHUB_MAX_RETRIES:
+                break
+            if 'Retry-After' in resp.headers:
+                delay = int(resp.headers['Retry-After'])
+            elif remaining == '0':
+                delay = int(resp.headers.get('X-RateLimit-Reset', 0)) - time.time()
+            else:
+                delay = 2 ** attempt
+            if delay > GITHUB_MAX_WAIT:
+                logger.error(f"GitHub {method} {url} rate limited for {delay:.0f}s, giving up")
+                break
+            logger.warning(f"GitHub {method} {url} returned {resp.status_code}, retrying in {max(delay, 0):.0f}s")
+            time.sleep(max(delay, 0))
+        return resp
+
     def load_amazon_links(self):
         path = 'data/amazon_links.json'
         if os.path.exists(path):
@@ -45,67 +119,71 @@ class WebsiteAffiliateBot:
                     return progress
             if os.path.exists('data/progress.json'):
                 with open('data/progress.json', 'r') as f:
-                    data = json.load(f)
-                    return data.get('current_index', 0)
+                    return json.load(f)
         except Exception as e:
             logger.error(f"Error loading progress: {e}")
-        return 0
+        return {}
 
     def get_progress_from_github(self):
-        url = f"https://api.github.com/repos/{WEBSITE_REPO}/contents/data/progress.json"
-        headers = {'Authorization': f'token {GITHUB_TOKEN}'}
+        url = f"{self.github_api}/contents/data/progress.json"
         try:
-            response = requests.get(url, headers=headers, timeout=15)
+            response = self.github_request('GET', url, timeout=15)
             if response.status_code == 200:
                 file_content = response.json()
                 content = base64.b64decode(file_content['content']).decode('utf-8')
-                data = json.loads(content)
-                return data.get('current_index', 0)
+                return json.loads(content)
         except Exception:
             return None
 
     def save_progress(self):
+        total_links = len(self.links)
+        position_in_cycle, completion_percentage = 1, 0.0
+        if total_links:
+            # Next link to post (1-based) in cycle_number; completion counts the links before it
+            position_in_cycle = self.current_index % total_links + 1
+            completion_percentage = round((position_in_cycle - 1) / total_links * 100, 2)
         progress_data = {
             'current_index': self.current_index,
-            'total_links': len(self.links),
-            'last_updated': datetime.now(pytz.timezone('Asia/Kolkata')).isoformat(),
+            'cycle_number': self.cycle_number,
+            'position_in_cycle': position_in_cycle,
+            'completion_percentage': completion_percentage,
+            'total_links': total_links,
+            'last_updated': datetime.now(IST).isoformat(),
             'session_type': SESSION_TYPE
         }
         path = 'data/progress.json'
-        with open(path, 'w') as f:
-            json.dump(progress_data, f, indent=2)
-        asyncio.create_task(self.update_progress_on_github(progress_data))
-
-    async def update_progress_on_github(self, progress_data):
-        if not GITHUB_TOKEN:
-            return False
-        await self.commit_to_github(
-            'data/progress.json',
-            json.dumps(progress_data, indent=2)
-        )
+        payload = json.dumps(progress_data, indent=2)
+        # Write to a temp file and rename so a killed run never leaves a truncated progress.json
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Error saving progress: {e}")
+        # Pushed to GitHub together with products.json at the end of run()
+        self.progress_payload = payload
 
-    def convert_amazon_link(self, url):
-        """Convert Amazon link to include affiliate tag"""
+    def convert_amazon_link(self, url, asin):
+        """Convert Amazon link to include affiliate tag; asin is extract_asin_from_url's result (None if absent)"""
         try:
             if not AMAZON_AFFILIATE_TAG:
                 logger.warning("No affiliate tag configured - using original link")
                 return url
             
             # Remove existing affiliate tags
-            url = re.sub(r'[?&]tag=[^&]*', '', url)
+            url = TAG_RE.sub('', url)
             
-            # Extract ASIN and create clean link
-            asin_match = re.search(r'/dp/([A-Z0-9]{10})', url)
-            if asin_match:
-                asin = asin_match.group(1)
+            # Create clean link from the ASIN
+            if asin:
                 converted = f"https://www.amazon.in/dp/{asin}?tag={AMAZON_AFFILIATE_TAG}"
-                logger.info(f"Converted link: {url[:50]}... -> {converted}")
+                logger.debug("Converted link: %s... -> %s", url[:50], converted)
                 return converted
             
             # Fallback: append tag
             separator = '&' if '?' in url else '?'
             converted = f"{url}{separator}tag={AMAZON_AFFILIATE_TAG}"
-            logger.info(f"Appended tag to link: {converted[:80]}...")
+            logger.debug("Appended tag to link: %s...", converted[:80])
             return converted
             
         except Exception as e:
@@ -113,24 +191,14 @@ class WebsiteAffiliateBot:
             return url
 
     def extract_asin_from_url(self, url):
-        match = re.search(r'/dp/([A-Z0-9]{10})', url)
+        match = ASIN_RE.search(url)
         return match.group(1) if match else None
 
     def categorize_by_title(self, title):
         title_lower = title.lower()
-
-        categories = {
-            'electronics': ['phone', 'smartphone', 'mobile', 'laptop', 'computer', 'tablet', 'earphone', 'headphone', 'charger', 'cable', 'speaker', 'camera', 'television'],
-            'fashion': ['shirt', 'tshirt', 'jeans', 'dress', 'shoes', 'watch', 'bag', 'clothing', 'jacket', 'cap', 'sunglasses', 'wallet'],
-            'home': ['kitchen', 'furniture', 'home', 'decor', 'appliance', 'bedsheet', 'pillow', 'chair', 'table', 'lamp', 'mattress', 'curtain'],
-            'health': ['skincare', 'beauty', 'cosmetic', 'health', 'supplement', 'medicine', 'cream', 'oil', 'soap', 'vitamin', 'hygiene']
-        }
-
-        for category, keywords in categories.items():
-            for kw in keywords:
-                if kw in title_lower:
-                    return category
-
+        for category, pattern in CATEGORY_RES:
+            if pattern.search(title_lower):
+                return category
         return 'electronics'  # Default category if none matched
 
     async def get_real_product_info_serpapi(self, asin):
@@ -143,7 +211,10 @@ class WebsiteAffiliateBot:
                 'k': asin,
                 'api_key': SERP_API_KEY
             }
-            resp = requests.get('https://serpapi.com/search', params=params, timeout=30)
+            async with self.serp_semaphore:
+                resp = await asyncio.to_thread(
+                    self.http.get, 'https://serpapi.com/search', params=params, timeout=30
+                )
             if resp.status_code == 200:
                 result = resp.json().get('organic_results', [])
                 prod = next((r for r in result if r.get('asin') == asin), None)
@@ -179,10 +250,9 @@ class WebsiteAffiliateBot:
     async def get_website_products(self):
         if not GITHUB_TOKEN:
             return []
-        url = f"https://api.github.com/repos/{WEBSITE_REPO}/contents/data/products.json"
-        headers = {'Authorization': f'token {GITHUB_TOKEN}'}
+        url = f"{self.github_api}/contents/data/products.json"
         try:
-            resp = requests.get(url, headers=headers, timeout=15)
+            resp = await asyncio.to_thread(self.github_request, 'GET', url, timeout=15)
             if resp.status_code == 200:
                 file_content = resp.json()
                 content = base64.b64decode(file_content['content']).decode('utf-8')
@@ -192,52 +262,91 @@ class WebsiteAffiliateBot:
             pass
         return []
 
-    async def commit_to_github(self, file_path, content):
-        url = f"https://api.github.com/repos/{WEBSITE_REPO}/contents/{file_path}"
-        headers = {'Authorization': f'token {GITHUB_TOKEN}'}
-        sha = None
-        get_resp = requests.get(url, headers=headers, timeout=10)
-        if get_resp.status_code == 200:
-            sha = get_resp.json()['sha']
-        encoded_content = base64.b64encode(content.encode('utf-8')).decode('utf-8')
-        commit_data = {
-            'message': f'Auto-update: {SESSION_TYPE} - Index {self.current_index}',
-            'content': encoded_content,
-            'branch': 'main'
-        }
-        if sha:
-            commit_data['sha'] = sha
-        resp = requests.put(url, headers=headers, json=commit_data, timeout=30)
-        return resp.status_code in [200, 201]
+    async def get_branch_head(self):
+        """Return (commit_sha, tree_sha) for main from a single branches/main lookup"""
+        url = f"{self.github_api}/branches/main"
+        resp = await asyncio.to_thread(self.github_request, 'GET', url, timeout=10)
+        resp.raise_for_status()
+        commit = resp.json()['commit']
+        return commit['sha'], commit['commit']['tree']['sha']
+
+    async def commit_files_to_github(self, files):
+        """Commit several files to the website repo as one commit via the Git Data API"""
+        if not GITHUB_TOKEN:
+            return False
+        api = f"{self.github_api}/git"
+        try:
+            for attempt in range(2):
+                head_sha, base_tree = await self.get_branch_head()
+                tree_data = {
+                    'base_tree': base_tree,
+                    'tree': [
+                        {'path': path, 'mode': '100644', 'type': 'blob', 'content': content}
+                        for path, content in files.items()
+                    ]
+                }
+                tree_resp = await asyncio.to_thread(self.github_request, 'POST', f"{api}/trees", json=tree_data, timeout=30)
+                tree_resp.raise_for_status()
+                commit_data = {
+                    'message': f'Auto-update: {SESSION_TYPE} - Index {self.current_index}',
+                    'tree': tree_resp.json()['sha'],
+                    'parents': [head_sha]
+                }
+                commit_resp = await asyncio.to_thread(self.github_request, 'POST', f"{api}/commits", json=commit_data, timeout=30)
+                commit_resp.raise_for_status()
+                ref_data = {'sha': commit_resp.json()['sha']}
+                update_resp = await asyncio.to_thread(self.github_request, 'PATCH', f"{api}/refs/heads/main", json=ref_data, timeout=30)
+                if update_resp.status_code == 422 and attempt == 0:
+                    # Not a fast-forward: main moved since the head was read, so re-read it and rebuild once.
+                    # The files are rebuilt from the same payloads, so a concurrent change to
+                    # products.json made in the meantime is overwritten.
+                    continue
+                update_resp.raise_for_status()
+                return True
+        except Exception:
+            logger.error(traceback.format_exc())
+        return False
 
     def get_next_links(self, count):
         links = []
-        for _ in range(count):
-            if not self.links:
-                break
-            if self.current_index >= len(self.links):
-                self.current_index = 0
-            links.append(self.links[self.current_index])
-            self.current_index += 1
+        if self.links and count > 0:
+            total = len(self.links)
+            # Links already used in the current cycle (current_index == total: new cycle, none used)
+            used = self.current_index % total
+            links = [self.links[(used + i) % total] for i in range(count)]
+            # A cycle is counted as soon as its last link is used
+            wraps, used = divmod(used + count, total)
+            self.cycle_number += wraps
+            # Stays in 1..total (never wraps to 0) so current_index - 1 is the last link used
+            self.current_index = used or total
         self.save_progress()
         return links
 
     async def run(self):
         logger.info("Posting product links continuously to website -- NO TELEGRAM")
+        started = time.monotonic()
         next_links = self.get_next_links(PRODUCTS_PER_RUN)
         if not next_links:
             logger.warning("No Amazon links to post.")
             return
-        website_products = await self.get_website_products()
-        for link in next_links:
-            asin = self.extract_asin_from_url(link)
-            info = await self.get_real_product_info_serpapi(asin)
-            
+        asins = [self.extract_asin_from_url(link) for link in next_links]
+        # Fetch products.json while the SerpAPI lookups are in flight instead of before them
+        existing_products, *infos = await asyncio.gather(
+            self.get_website_products(),
+            *(self.get_real_product_info_serpapi(asin) for asin in asins)
+        )
+        # Newest first; maxlen drops the oldest entries as new ones are pushed on the left
+        website_products = deque(existing_products[:MAX_WEBSITE_PRODUCTS], maxlen=MAX_WEBSITE_PRODUCTS)
+        # One timestamp for the whole batch
+        now = datetime.now(IST)
+        now_iso = now.isoformat()
+        id_stamp = now.strftime('%Y%m%d_%H%M%S')
+        for i, (link, asin, info) in enumerate(zip(next_links, asins, infos), 1):
             # Convert the link with affiliate tag
-            converted_link = self.convert_amazon_link(link)
+            converted_link = self.convert_amazon_link(link, asin)
             
             product = {
-                'id': f"product_{SESSION_TYPE}_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                'id': f"product_{SESSION_TYPE}_{id_stamp}_{i}",
                 'title': info['title'],
                 'image': info['image'],
                 'affiliate_link': converted_link,
@@ -246,22 +355,29 @@ class WebsiteAffiliateBot:
                 'category': info['category'],
                 'asin': info['asin'],
                 'data_source': info['source'],
-                'posted_date': datetime.now(pytz.timezone('Asia/Kolkata')).isoformat(),
+                'posted_date': now_iso,
                 'session_type': SESSION_TYPE,
                 'link_index': self.current_index - 1
             }
-            website_products.insert(0, product)
+            website_products.appendleft(product)
         updated_data = {
-            "last_updated": datetime.now(pytz.timezone('Asia/Kolkata')).isoformat(),
+            "last_updated": now_iso,
             "total_products": len(website_products),
-            "products": website_products
+            "products": list(website_products)
         }
-        await self.commit_to_github('data/products.json', json.dumps(updated_data, indent=2))
-        logger.info(f"Posted {len(next_links)} products. Total now: {len(website_products)}")
+        await self.commit_files_to_github({
+            # Machine-read only, so skip pretty-printing to keep the committed payload small
+            'data/products.json': json.dumps(updated_data, separators=(',', ':'), ensure_ascii=False),
+            'data/progress.json': self.progress_payload
+        })
+        logger.info(f"Posted {len(next_links)} products in {time.monotonic() - started:.2f}s. Total now: {len(website_products)}")
 
 async def main():
     bot = WebsiteAffiliateBot()
-    await bot.run()
+    try:
+        await bot.run()
+    finally:
+        bot.http.close()
 
 if __name__ == '__main__':
     asyncio.run(main())